@@ -1,14 +1,23 @@
+import functools
+import hashlib
 import os
+import shelve
 import time
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import orjson
 import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 import gspread
+from gspread.utils import ValueRenderOption
 from oauth2client.service_account import ServiceAccountCredentials
 import smtplib
 from email.mime.text import MIMEText
-from datetime import datetime
-from gspread_formatting import CellFormat, Color, format_cell_range, TextFormat
-import schedule  # For scheduling the weekly email alerts
+from datetime import datetime, timedelta
+from gspread_formatting import CellFormat, Color, format_cell_ranges, TextFormat
 
 # Load environment variables
 load_dotenv()
@@ -16,10 +25,42 @@ load_dotenv()
 # API and Google credentials
 API_KEY = os.getenv("API_KEY")
 EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
+ORIGINS = os.getenv("ORIGINS", "CLT,RDU,IAD,JFK")  # Add this for dynamic origins
 DESTINATIONS = os.getenv("DESTINATIONS", "PMO,FCO,MXP,CTA")  # Add this for dynamic destinations
 PRICE_THRESHOLD = 400  # Add this for price alerts (can be updated dynamically)
 
-# Google Sheets setup
+BASE_URL = "https://tequila-api.kiwi.com/v2/search"
+
+# Preferred destination cities (frozenset for O(1) membership checks)
+PREFERRED_DESTINATIONS = frozenset(("Palermo", "Catania", "Rome", "Milan"))
+
+# Sheet header row, verified against the sheet once per process
+EXPECTED_HEADERS = ["Price (USD)", "Duration", "Origin", "Destination", "Departure Time", "Booking Link"]
+
+# Column G turns the raw URLs in column F into "Book Now" links; one formula
+# evaluated in bulk server-side instead of a parsed =HYPERLINK per written cell
+BOOKING_LINK_FORMULA = '=ARRAYFORMULA(IF(F2:F="", "", HYPERLINK(F2:F, "Book Now")))'
+_headers_verified = False
+_sheet_formatted = False
+_next_row = None  # First empty sheet row; queried once, then tracked locally
+
+# On-disk record of flights already written to the sheet, so re-runs don't
+# append duplicate rows
+SEEN_FLIGHTS_PATH = os.path.join(os.path.dirname(__file__), "seen_flights.db")
+
+# Shared HTTP session for the Kiwi API: reuses the TLS connection across calls,
+# retries transient failures with exponential backoff, and serves repeat queries
+# (same params within 15 minutes) from a local SQLite cache instead of burning quota
+SESSION = requests_cache.CachedSession("kiwi_cache", backend="sqlite", expire_after=900)
+SESSION.headers.update({"apikey": API_KEY})
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+# Google Sheets setup (cached so the OAuth token exchange happens once per process)
+@functools.lru_cache(maxsize=1)
 def setup_google_sheets():
     # Absolute path for credentials.json
     credentials_path = os.path.join(os.path.dirname(__file__), "credentials.json")
@@ -28,94 +69,171 @@ def setup_google_sheets():
     client = gspread.authorize(credentials)
     return client.open("Flight Tracker").sheet1  # Ensure the Google Sheet is named "Flight Tracker"
 
-# Fetch flight data from Kiwi API
-def fetch_flight_data():
-    print("Fetching flight data...")
-    BASE_URL = "https://tequila-api.kiwi.com/v2/search"
-    headers = {"apikey": API_KEY}
-    destinations = "PMO, CTA, FCO, MXP"
+# Fetch one (origin, destination) pair from the Kiwi API
+def fetch_flight_pair(origin, destination):
     params = {
-        "fly_from": "CLT,RDU,IAD,JFK",  # Multiple origin airports
-        "fly_to": destinations,         # Dynamic destinations
+        "fly_from": origin,
+        "fly_to": destination,
         "date_from": "01/06/2025",
         "date_to": "30/06/2025",
         "limit": 10                     # Limit to 10 results
     }
+    response = SESSION.get(BASE_URL, params=params, timeout=(3.05, 10))
+    response.raise_for_status()
+    # orjson parses the raw bytes directly, skipping the UTF-8 str round trip
+    # that response.json() takes through response.text
+    return orjson.loads(response.content).get("data", [])
+
+# Fetch flight data for every origin/destination pair concurrently
+def fetch_flight_data():
+    print("Fetching flight data...")
+    origins = [o.strip() for o in ORIGINS.split(",")]
+    destinations = [d.strip() for d in DESTINATIONS.split(",")]
+
+    flights = []
+    # 4 workers keeps us inside Kiwi's rate limits while overlapping the I/O waits
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [
+            executor.submit(fetch_flight_pair, origin, destination)
+            for origin in origins
+            for destination in destinations
+        ]
+        for future in as_completed(futures):
+            try:
+                flights.extend(future.result())
+            except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+                print(f"Error fetching flight data: {e}")
+
+    print(f"Fetched {len(flights)} flights.")
+    return flights
+
+# Short fingerprint identifying a flight offer (blake2b is fast; cryptographic
+# strength isn't needed here)
+def flight_fingerprint(flight):
+    key = f"{flight.get('deep_link')}|{flight.get('price')}"
+    return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+# Precompiled extractors: one C-level call per flight/route instead of a dict
+# subscription for every field in the row
+_flight_fields = itemgetter("duration", "deep_link")
+_route_fields = itemgetter("cityFrom", "cityTo", "utc_departure")
+
+# Build a single sheet row from a flight dict (None if expected keys are missing)
+def build_row(flight):
     try:
-        response = requests.get(BASE_URL, headers=headers, params=params)
-        response.raise_for_status()
-        flights = response.json().get("data", [])
-        print(f"Fetched {len(flights)} flights.")
-        return flights
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching flight data: {e}")
-        return []
+        duration, deep_link = _flight_fields(flight)
+        city_from, city_to, departure_time_utc = _route_fields(flight["route"][0])
+
+        # Convert seconds to hours and minutes
+        duration_seconds = duration["departure"]
+        hours = int(duration_seconds // 3600)
+        minutes = int((duration_seconds % 3600) // 60)
+        formatted_duration = f"{hours}h {minutes}m"
+
+        # Format the departure time (fromisoformat is C-level, unlike strptime
+        # which recompiles its format string on every call)
+        departure_time_local = datetime.fromisoformat(departure_time_utc).isoformat(sep=' ')[:16]
+
+        # Create the row (column F takes the raw URL — the ARRAYFORMULA in
+        # column G renders the clickable link)
+        return [
+            f"${flight['price']}" if "price" in flight else "N/A",  # Add $ symbol
+            formatted_duration,  # Format duration in hours and minutes
+            city_from,
+            city_to,
+            departure_time_local,  # Formatted departure time
+            deep_link  # Simplified link
+        ]
+    except KeyError as e:
+        print(f"Missing key in flight data: {e}")
+        return None
 
 # Save data to Google Sheets
 def save_to_google_sheets(flights, sheet):
-    # List of preferred destination cities
-    preferred_destinations = ["Palermo", "Catania", "Rome", "Milan"]
-
-    # Filter flights for preferred destinations
-    filtered_flights = [
-        flight for flight in flights
-        if flight["route"][0]["cityTo"] in preferred_destinations
-    ]
-
-    # Check if headers already exist
-    existing_data = sheet.get_all_values()
-    if not existing_data or existing_data[0] != ["Price (USD)", "Duration", "Origin", "Destination", "Departure Time", "Booking Link"]:
-        headers = ["Price (USD)", "Duration", "Origin", "Destination", "Departure Time", "Booking Link"]
-        sheet.insert_row(headers, index=1)  # Add headers to the first row
-
-    # Append filtered flight data rows
-    for flight in filtered_flights:
-        try:
-            # Convert seconds to hours and minutes
-            duration_seconds = flight["duration"]["departure"]
-            hours = int(duration_seconds // 3600)
-            minutes = int((duration_seconds % 3600) // 60)
-            formatted_duration = f"{hours}h {minutes}m"
-            
-            # Format the departure time
-            departure_time_utc = flight["route"][0]["utc_departure"]
-            departure_time_local = datetime.strptime(departure_time_utc, "%Y-%m-%dT%H:%M:%S.%fZ").strftime('%Y-%m-%d %H:%M')
-
-            # Simplify the booking link
-            deep_link = flight["deep_link"]
-            booking_link = f'=HYPERLINK("{deep_link}", "Book Now")'
-
-            # Create the row
-            row = [
-                f"${flight['price']}" if "price" in flight else "N/A",  # Add $ symbol
-                formatted_duration,  # Format duration in hours and minutes
-                flight["route"][0]["cityFrom"],
-                flight["route"][0]["cityTo"],
-                departure_time_local,  # Formatted departure time
-                booking_link  # Simplified link
-            ]
-
-            # Append the row to the Google Sheet
-            sheet.append_row(row, value_input_option="USER_ENTERED")  # Ensures formulas are interpreted
-        except KeyError as e:
-            print(f"Missing key in flight data: {e}")
-    print(f"Filtered {len(filtered_flights)} flights saved to Google Sheets.")
-
-# Send email notifications for price changes
-def send_email_notification(subject, body, booking_url):
+    global _headers_verified, _next_row
+
+    # Build every row locally so the sheet is written in a single batch call
+    rows = []
+
+    # Check if headers already exist — fetch just row 1 rather than downloading
+    # the entire sheet, and only on the first save of the process
+    if not _headers_verified:
+        first_row = sheet.row_values(1)
+        if not first_row:
+            rows.append(EXPECTED_HEADERS)  # Fold the header row into the same batch
+        elif first_row != EXPECTED_HEADERS:
+            sheet.insert_row(EXPECTED_HEADERS, index=1)  # Add headers to the first row
+        # Install the link-column formula if it's missing — covers sheets that
+        # already had correct headers before the raw-URL switch, not just fresh ones
+        if not sheet.acell("G2", value_render_option=ValueRenderOption.formula).value:
+            sheet.update_acell("G2", BOOKING_LINK_FORMULA)
+        _headers_verified = True
+
+    # Locate the first empty row once per process; afterwards we track it
+    # ourselves so the server never re-scans a growing sheet on each write
+    if _next_row is None:
+        _next_row = len(sheet.col_values(1)) + 1
+
+    # Filter and build in a single pass over the flights, skipping any offer
+    # whose fingerprint was already written by an earlier run
+    flight_rows = []
+    pending_fingerprints = set()  # Persisted only after the sheet write succeeds
+    with shelve.open(SEEN_FLIGHTS_PATH) as seen:
+        for flight in flights:
+            if flight["route"][0]["cityTo"] not in PREFERRED_DESTINATIONS:
+                continue
+            fingerprint = flight_fingerprint(flight)
+            if fingerprint in seen or fingerprint in pending_fingerprints:
+                continue
+            row = build_row(flight)
+            if row is not None:
+                pending_fingerprints.add(fingerprint)
+                flight_rows.append(row)
+    rows.extend(flight_rows)
+
+    # Write all rows to an explicit range in one request — values.update with a
+    # known start row skips the server-side "find first empty row" scan that
+    # append does, so write latency stays flat as history accumulates
+    if rows:
+        sheet.update(rows, f"A{_next_row}", value_input_option="USER_ENTERED")  # Ensures formulas are interpreted
+        _next_row += len(rows)
+
+    # Only now that the write went through, record the flights as saved — if the
+    # update raised (e.g. an expired token), they stay eligible for the retry
+    if pending_fingerprints:
+        with shelve.open(SEEN_FLIGHTS_PATH) as seen:
+            for fingerprint in pending_fingerprints:
+                seen[fingerprint] = True
+    print(f"Filtered {len(flight_rows)} flights saved to Google Sheets.")
+
+# Send one digest email covering every deal (a single SMTP session and message
+# instead of a TLS handshake + login per flight)
+def send_deal_digest(deals):
     sender_email = "banton65@gmail.com"  # Replace with your email
     receiver_email = "banton65@gmail.com"  # Replace with your email
-    
+
+    subject = f"🔥 Flight Alert: {len(deals)} deal(s) under ${PRICE_THRESHOLD}"
+
     # Create an HTML email for better formatting
+    deal_items = "".join(
+        f"""
+            <li>
+                ${flight['price']} — {flight['route'][0]['cityFrom']} to {flight['route'][0]['cityTo']},
+                departing {flight['route'][0]['local_departure']}
+                (<a href="{flight['deep_link']}" target="_blank">Book Now</a>)
+            </li>"""
+        for flight in deals
+    )
     html_body = f"""
     <html>
         <body>
-            <p>{body}</p>
-            <p>Book here: <a href="{booking_url}" target="_blank">Click Here to Book</a></p>
+            <p>Great Deals!</p>
+            <ul>{deal_items}
+            </ul>
         </body>
     </html>
     """
-    
+
     # MIMEText with HTML content
     msg = MIMEText(html_body, "html")
     msg["Subject"] = subject
@@ -132,51 +250,65 @@ def send_email_notification(subject, body, booking_url):
 
         
 def format_google_sheet(sheet):
+    global _sheet_formatted
+    if _sheet_formatted:
+        return  # Formatting is static, so once per process is enough
+
     # Header formatting (bold, centered)
     header_format = CellFormat(
         backgroundColor=Color(0.9, 0.9, 0.9),  # Light gray
         textFormat=TextFormat(bold=True, foregroundColor=Color(0, 0, 0))
     )
-    format_cell_range(sheet, "A1:F1", header_format)
 
     # Body formatting (e.g., alternate row colors)
     body_format = CellFormat(
         backgroundColor=Color(1, 1, 1),  # White
         textFormat=TextFormat(foregroundColor=Color(0, 0, 0))
     )
-    format_cell_range(sheet, "A2:F", body_format)
+
+    # Both ranges go out in a single batch_update call
+    format_cell_ranges(sheet, [("A1:F1", header_format), ("A2:F", body_format)])
+    _sheet_formatted = True
+
+# Filter flights against the price threshold and send the digest for any deals
+def notify(flights):
+    deals = [flight for flight in flights if flight["price"] < PRICE_THRESHOLD]
+    if deals:
+        send_deal_digest(deals)
+    else:
+        print(f"No flights under ${PRICE_THRESHOLD} found.")
 
 # Main function to fetch flights and notify
 def fetch_and_notify():
     print("Checking for flight deals...")
+    SESSION.cache.delete(expired=True)  # Keep the response cache from growing unbounded
     sheet = setup_google_sheets()
     flights = fetch_flight_data()
 
     if flights:
-        save_to_google_sheets(flights, sheet)
+        try:
+            save_to_google_sheets(flights, sheet)
+        except gspread.exceptions.APIError as e:
+            if e.code != 401:
+                raise
+            # Cached credentials expired; rebuild the client and retry once
+            setup_google_sheets.cache_clear()
+            sheet = setup_google_sheets()
+            save_to_google_sheets(flights, sheet)
         format_google_sheet(sheet)
 
-        has_deals = False  # Track if any flight meets the price threshold
-        for flight in flights:
-            # Notify if price drops below threshold
-            if flight["price"] < PRICE_THRESHOLD:
-                has_deals = True
-                subject = f"🔥 Flight Alert: ${flight['price']} - {flight['route'][0]['cityFrom']} to {flight['route'][0]['cityTo']}"
-                body = f"""
-                Great Deal!
-                - Price: ${flight['price']}
-                - From: {flight['route'][0]['cityFrom']} to {flight['route'][0]['cityTo']}
-                - Departure: {flight['route'][0]['local_departure']}
-                """
-                send_email_notification(subject, body, flight["deep_link"])
-
-        if not has_deals:
-            print(f"No flights under ${PRICE_THRESHOLD} found.")
+        notify(flights)
     else:
         print("No flights available.")
 
-# Schedule the script to run weekly
-schedule.every().monday.at("08:00").do(fetch_and_notify)
+# Seconds until the next Monday 08:00 (the weekly run time)
+def seconds_until_next_run():
+    now = datetime.now()
+    days_ahead = -now.weekday() % 7  # Monday is weekday 0
+    next_run = (now + timedelta(days=days_ahead)).replace(hour=8, minute=0, second=0, microsecond=0)
+    if next_run <= now:
+        next_run += timedelta(days=7)
+    return (next_run - now).total_seconds()
 
 
 if __name__ == "__main__":
@@ -190,5 +322,8 @@ if __name__ == "__main__":
         fetch_and_notify()
     else:
         while True:
-            schedule.run_pending()
-            time.sleep(1)  # Wait a second before checking the schedule again
+            # Sleep straight through to the next run instead of waking every second
+            wait = seconds_until_next_run()
+            print(f"Next check in {wait / 3600:.1f} hours.")
+            time.sleep(wait)
+            fetch_and_notify()